@@ -1,46 +1,66 @@
 import concurrent.futures
 import os.path
+import sys
+import threading
 from abc import abstractmethod
+from collections import Counter
 from datetime import datetime
-from time import sleep
+from time import sleep, monotonic
 
+import requests
 from alive_progress import alive_bar
 from colorama import Fore, init
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from pb_analyzer.const import ResponseKeys
+from pb_analyzer.const import MAX_WORKERS, ANALYSIS_TIME_LIMIT, ANALYSIS_TIME_LIMIT_MINUTES, DEBUG_ERROR_EXAMPLES, \
+    ReportResult
 from pb_analyzer.utils import write_to_txt, write_to_csv, split_and_format
 
 
 class BaseAnalyzer:
     def __init__(self, tool: str, result_output_path: str, is_default_results_path: bool, results_output_path: str,
-                 debug: bool = False):
+                 debug: bool = False, max_workers: int = MAX_WORKERS):
+        if max_workers < 1:
+            raise ValueError(f'max_workers must be at least 1, got {max_workers}')
         self._debug = debug
+        self._max_workers = max_workers
+        self._interactive = sys.stdout.isatty()
         self._result_output_path = result_output_path
         self._summary_output_path = results_output_path
         self._is_default_results_path = is_default_results_path
         self._results = []
         self._tool = tool
-        self._unused_columns = []
+        self._columns_by_key = {}
         self._total_columns_scanned = 0
         self._reports_with_hidden_columns = 0
         self._reports_with_unused_columns = 0
         self._success_count = 0
         self._errors = []
+        self._session = self._create_session(max_workers)
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _create_session(pool_size: int) -> requests.Session:
+        session = requests.Session()
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']), respect_retry_after_header=True,
+                      raise_on_status=False)
+        session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size))
+        return session
 
     def _insert_all_columns(self, all_columns, num_of_hidden):
         if num_of_hidden > 0:
             self._reports_with_hidden_columns += 1
 
+        columns_by_key = self._columns_by_key
         for column in all_columns:
-            if not any(existing_column[ResponseKeys.TABLE] == column[ResponseKeys.TABLE] and existing_column[
-                ResponseKeys.COLUMN] == column[ResponseKeys.COLUMN] for
-                       existing_column in self._unused_columns):
-                self._unused_columns.append(column)
+            key = (column.table, column.column)
+            existing_column = columns_by_key.get(key)
+            if existing_column is None:
+                columns_by_key[key] = column
             else:
-                for existing_column in self._unused_columns:
-                    if (existing_column[ResponseKeys.TABLE] == column[ResponseKeys.TABLE]
-                            and existing_column[ResponseKeys.COLUMN] == column[ResponseKeys.COLUMN]):
-                        existing_column[ResponseKeys.UNUSED] = True
+                existing_column.unused = True
 
     @staticmethod
     def _insert_new_path(path, suffix: str):
@@ -78,94 +98,135 @@ class BaseAnalyzer:
         print()
 
     @abstractmethod
-    def _process_report(self, row, bar, start_time, *args):
+    def _process_report(self, row, deadline, *args):
         raise NotImplementedError
 
+    def _process_report_task(self, row, deadline, *args):
+        if self._stop.is_set():
+            return None
+        try:
+            return self._process_report(row, deadline, *args)
+        except TimeoutError as e:
+            if self._debug:
+                print(Fore.RED + str(e))
+            self._stop.set()
+            return None
+
+    def _record_report(self, result: ReportResult):
+        if result.error:
+            self._errors.append(result.error)
+            return
+        if result.columns is None:
+            return
+        self._insert_all_columns(result.columns, result.num_of_hidden)
+        self._success_count += 1
+        if result.row:
+            self._reports_with_unused_columns += 1
+            self._results.append(result.row)
+
+    def _record_future(self, future: concurrent.futures.Future, bar):
+        result = future.result()
+        if result is not None:
+            self._record_report(result)
+            bar()
+
     def _run_analysis(self, rows, *args):
         start_time = datetime.now()
+        deadline = monotonic() + ANALYSIS_TIME_LIMIT.total_seconds()
         timed_out = False
 
         with alive_bar(len(rows), bar='blocks') as bar:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = [executor.submit(self._process_report, row, bar, start_time, *args) for row in rows]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                futures = [executor.submit(self._process_report_task, row, deadline, *args) for row in rows]
+                pending = set(futures)
                 for future in concurrent.futures.as_completed(futures):
-                    try:
-                        future.result()
-                    except TimeoutError as e:
-                        if self._debug:
-                            print(Fore.RED + str(e))
-                        timed_out = True
-                        executor.shutdown(wait=False, cancel_futures=True)
+                    pending.discard(future)
+                    self._record_future(future, bar)
+                    if self._stop.is_set():
                         break
+                if self._stop.is_set():
+                    timed_out = True
+                    for future in pending:
+                        future.cancel()
+                    concurrent.futures.wait(pending)
+                    for future in pending:
+                        if not future.cancelled():
+                            self._record_future(future, bar)
             write_to_csv(self._result_output_path, self._results)
+        if self._debug and self._errors:
+            self._print_error_summary()
         if timed_out:
-            print(Fore.RED + 'Passed the 10 minutes mark. Stopped the analysis.')
-            sleep(1)
+            print(Fore.RED + f'Passed the {ANALYSIS_TIME_LIMIT_MINUTES} minutes mark. Stopped the analysis.')
+            if self._interactive:
+                sleep(1)
         end_time = datetime.now()
         return end_time, rows, start_time
 
+    def _print_error_summary(self):
+        error_counts = Counter(error[1] for error in self._errors)
+        output = [Fore.RED + f'Failed to analyze {len(self._errors)} reports:']
+        output += [Fore.RED + f'  {code}: {count}' for code, count in error_counts.most_common()]
+        output += [Fore.RED + f'  "{error[0]}": {error[2]}' for error in self._errors[:DEBUG_ERROR_EXAMPLES]]
+        sys.stdout.write('\n'.join(output) + '\n')
+        sys.stdout.flush()
+
     def _welcome_text(self):
         init(autoreset=True)
 
-        print(Fore.CYAN + "=" * 65)
-        print(Fore.YELLOW + "Welcome to Power BI Analyzer - Report Analysis Tool".center(65))
-        print(Fore.CYAN + "=" * 65)
-        sleep(0.3)
-        print()
-        print(Fore.GREEN + "Project: Power BI Analyzer")
-        sleep(0.3)
-        print(Fore.GREEN + f"Tool: {self._tool}")
-        print()
-        sleep(0.3)
-        print(Fore.WHITE + "This tool is part of the Power BI Analyzer project, which aims to help")
-        sleep(0.2)
-        print(Fore.WHITE + "organizations identify unused data sources in their Power BI reports.")
-        sleep(0.2)
-        print(Fore.WHITE + "Unused columns in your reports can pose a security risk, and it is")
-        sleep(0.2)
-        print(Fore.WHITE + "essential to identify and remove them to prevent data breaches.")
-        print()
-        sleep(0.5)
-        print(Fore.MAGENTA + "BACKGROUND:")
-        sleep(0.1)
-        print(Fore.WHITE + "On June 19, 2024, Nokod Security published a warning about a data leakage")
-        sleep(0.1)
-        print(Fore.WHITE + "vulnerability in the Microsoft Power BI service. For more details, visit:")
-        sleep(0.1)
-        print(
-            Fore.BLUE + "https://nokodsecurity.com/blog/in-plain-sight-how-microsoft-power-bi-reports-expose-sensitive-data-on-the-web/")
-        print()
-        sleep(0.5)
-        print(Fore.WHITE + "Nokod Security created the \"Power BI Analyzer\" as a simple and free tool")
-        sleep(0.1)
-        print(Fore.WHITE + "for organizations to assess their exposure to this vulnerability. If you")
-        sleep(0.1)
-        print(Fore.WHITE + "need help with this tool, please contact amichai@nokodsecurity.com or")
-        sleep(0.1)
-        print(Fore.WHITE + "uriya@nokodsecurity.com.")
-        print(Fore.CYAN + "=" * 65)
-        sleep(0.5)
+        banner = [
+            (Fore.CYAN + "=" * 65, 0),
+            (Fore.YELLOW + "Welcome to Power BI Analyzer - Report Analysis Tool".center(65), 0),
+            (Fore.CYAN + "=" * 65, 0.3),
+            ('', 0),
+            (Fore.GREEN + "Project: Power BI Analyzer", 0.3),
+            (Fore.GREEN + f"Tool: {self._tool}", 0),
+            ('', 0.3),
+            (Fore.WHITE + "This tool is part of the Power BI Analyzer project, which aims to help", 0.2),
+            (Fore.WHITE + "organizations identify unused data sources in their Power BI reports.", 0.2),
+            (Fore.WHITE + "Unused columns in your reports can pose a security risk, and it is", 0.2),
+            (Fore.WHITE + "essential to identify and remove them to prevent data breaches.", 0),
+            ('', 0.5),
+            (Fore.MAGENTA + "BACKGROUND:", 0.1),
+            (Fore.WHITE + "On June 19, 2024, Nokod Security published a warning about a data leakage", 0.1),
+            (Fore.WHITE + "vulnerability in the Microsoft Power BI service. For more details, visit:", 0.1),
+            (Fore.BLUE + "https://nokodsecurity.com/blog/in-plain-sight-how-microsoft-power-bi-reports-expose-sensitive-data-on-the-web/",
+             0),
+            ('', 0.5),
+            (Fore.WHITE + "Nokod Security created the \"Power BI Analyzer\" as a simple and free tool", 0.1),
+            (Fore.WHITE + "for organizations to assess their exposure to this vulnerability. If you", 0.1),
+            (Fore.WHITE + "need help with this tool, please contact amichai@nokodsecurity.com or", 0.1),
+            (Fore.WHITE + "uriya@nokodsecurity.com.", 0),
+            (Fore.CYAN + "=" * 65, 0.5),
+        ]
+
+        if not self._interactive:
+            sys.stdout.write('\n'.join(line for line, _ in banner) + '\n')
+            sys.stdout.flush()
+            return
+
+        for line, delay in banner:
+            print(line)
+            if delay:
+                sleep(delay)
 
     def _outro(self, end_time, rows, start_time):
-        print()
-        print(Fore.CYAN + "=" * 65)
-        print(Fore.MAGENTA + "Results".center(65))
-        print(Fore.CYAN + "=" * 65)
+        tables = set()
+        unused_count = 0
+        for column in self._columns_by_key.values():
+            tables.add(column.table)
+            if column.unused:
+                unused_count += 1
         results = [
             f'Number of reports analyzed successfully: {self._success_count}/{len(rows)}',
-            'Total tables scanned: ' + str(len(set([column['table'] for column in self._unused_columns]))),
-            'Unique columns scanned: ' + str(len(self._unused_columns)),
-            'Unused columns found: ' + str(
-                len([column for column in self._unused_columns if column.get(ResponseKeys.UNUSED)])),
+            'Total tables scanned: ' + str(len(tables)),
+            'Unique columns scanned: ' + str(len(self._columns_by_key)),
+            'Unused columns found: ' + str(unused_count),
             'Reports with unused columns: ' + str(self._reports_with_unused_columns),
             'Reports with hidden columns: ' + str(self._reports_with_hidden_columns),
             'Scan time: ' + str(end_time - start_time),
             ''
         ]
 
-        for line in results:
-            print(Fore.WHITE + line)
-
         error_messages = []
         if self._success_count != len(rows):
             if self._errors:
@@ -177,9 +238,13 @@ class BaseAnalyzer:
         closing = ['=' * 65]
         footer = ['', 'Full analysis saved to ' + self._result_output_path]
         write_to_txt(self._summary_output_path, title + header + results + closing + error_messages + footer)
-        print(Fore.CYAN + "=" * 65)
-        print()
-        [print(Fore.RED + line) for line in error_messages]
-        print()
-        print(Fore.GREEN + 'Full analysis saved to ' + self._result_output_path)
-        print(Fore.GREEN + 'Results saved to ' + self._summary_output_path)
+
+        output = ['', Fore.CYAN + "=" * 65, Fore.MAGENTA + "Results".center(65), Fore.CYAN + "=" * 65]
+        output += [Fore.WHITE + line for line in results]
+        output += [Fore.CYAN + "=" * 65, '']
+        output += [Fore.RED + line for line in error_messages]
+        output += ['',
+                   Fore.GREEN + 'Full analysis saved to ' + self._result_output_path,
+                   Fore.GREEN + 'Results saved to ' + self._summary_output_path]
+        sys.stdout.write('\n'.join(output) + '\n')
+        sys.stdout.flush()
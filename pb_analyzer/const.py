@@ -1,6 +1,18 @@
+import os
+from datetime import timedelta
+from typing import List, Optional
+
 SHARED_TO_ORG_HEADERS = ['Report Id', 'Report Name', 'Shared by', 'Number of hidden columns', 'Unused columns']
 NEW_HEADERS = ['Number of hidden columns', 'Unused columns']
 REGEX_BI_REQUEST = r"var resolvedClusterUri = 'https://(.*?)';"
+REGEX_EMBED_PAYLOAD = r'[?&]r=([^&#]+)'
+DATE_TABLE_PREFIXES = ('DateTableTemplate', 'LocalDateTable')
+MAX_WORKERS = 16
+ANALYSIS_TIME_LIMIT_MINUTES = 10
+ANALYSIS_TIME_LIMIT = timedelta(minutes=ANALYSIS_TIME_LIMIT_MINUTES)
+REQUEST_TIMEOUT = 30
+DEBUG_ERROR_EXAMPLES = 5
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pb_analyzer', 'token_cache.bin')
 
 
 class Requests:
@@ -32,9 +44,6 @@ class ResponseKeys:
     SHARER = 'sharer'
     UNKNOWN_REPORT = 'Unknown Report'
     UNKNOWN_SHARER = 'Unknown Sharer'
-    TABLE = 'table'
-    COLUMN = 'column'
-    UNUSED = 'unused'
     MODELS = 'models'
     ID = 'id'
     ENTITY_KEY = 'entityKey'
@@ -42,5 +51,28 @@ class ResponseKeys:
     TYPE = 'type'
 
 
+class ReportColumn:
+    __slots__ = ('table', 'column', 'unused')
+
+    def __init__(self, table: str, column: str, unused: bool = False):
+        self.table = table
+        self.column = column
+        self.unused = unused
+
+    def __repr__(self):
+        return f'ReportColumn(table={self.table!r}, column={self.column!r}, unused={self.unused!r})'
+
+
+class ReportResult:
+    __slots__ = ('columns', 'num_of_hidden', 'row', 'error')
+
+    def __init__(self, columns: Optional[List[ReportColumn]] = None, num_of_hidden: int = 0,
+                 row: Optional[List] = None, error: Optional[List[str]] = None):
+        self.columns = columns
+        self.num_of_hidden = num_of_hidden
+        self.row = row
+        self.error = error
+
+
 class ExplorationRequestError(Exception):
     pass
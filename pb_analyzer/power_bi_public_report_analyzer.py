@@ -1,28 +1,37 @@
 import argparse
 import base64
+import concurrent.futures
 import csv
-import json
 import os
 import re
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Union
-from urllib.parse import urlparse, parse_qs, ParseResult
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import List, Optional, Dict
+from urllib.parse import urlparse, unquote
 
 import requests
 from colorama import Fore
 
 from pb_analyzer.base_analyzer import BaseAnalyzer
-from pb_analyzer.const import PublicRequests, REGEX_BI_REQUEST, NEW_HEADERS, ResponseKeys, ExplorationRequestError
-from pb_analyzer.utils import count_hidden_true_in_dict, get_classified_columns, \
-    write_to_csv, fetch_columns_and_tables
+from pb_analyzer.const import PublicRequests, REGEX_BI_REQUEST, REGEX_EMBED_PAYLOAD, NEW_HEADERS, ResponseKeys, \
+    ExplorationRequestError, ReportResult, MAX_WORKERS, REQUEST_TIMEOUT, ANALYSIS_TIME_LIMIT, \
+    ANALYSIS_TIME_LIMIT_MINUTES
+from pb_analyzer.utils import fetch_columns_and_hidden_count, get_classified_columns, load_json, write_to_csv, \
+    positive_int
+
+_BI_REQUEST_RE: re.Pattern = re.compile(REGEX_BI_REQUEST.encode('utf-8'))
+_EMBED_PAYLOAD_RE: re.Pattern = re.compile(REGEX_EMBED_PAYLOAD)
 
 
 class PublicReportsAnalyzer(BaseAnalyzer):
-    def __init__(self, embed_codes_file_path: str, output_folder: str = None, debug: bool = False):
+    def __init__(self, embed_codes_file_path: str, output_folder: str = None, debug: bool = False,
+                 max_workers: int = MAX_WORKERS):
         """
         Args:
             embed_codes_file_path:  The full path to the Power BI Reports CSV file.
             output_folder: The path to the output folder.
+            max_workers: The number of reports analyzed concurrently.
 
         Example usage:
         PublicReportAnalyzer('C:/Users/username/Downloads/PowerBIReports.csv', 'C:/Users/username/Downloads/Output.csv').analyze()
@@ -35,21 +44,23 @@ class PublicReportsAnalyzer(BaseAnalyzer):
             exit(1)
         self._embed_codes_file_path = embed_codes_file_path
         is_default_results_path = True
-
-        results_output_path = os.path.join(os.getcwd(), f'PublicReportsWithUnusedData_{time}.csv')
-        summary_output_path = os.path.join(os.getcwd(), f'PBAnalyzerResults_{time}.txt')
+        output_dir = os.getcwd()
 
         if output_folder:
             if '.' in os.path.basename(output_folder):
                 print(Fore.RED + 'Invalid output folder path. Using default path.')
-            if not os.path.isdir(output_folder):
-                os.makedirs(output_folder)
-            is_default_results_path = False
-            results_output_path = os.path.join(output_folder, f'PublicReportsWithUnusedData_{time}.csv')
-            summary_output_path = os.path.join(output_folder, f'PBAnalyzerResults_{time}.txt')
+            else:
+                os.makedirs(output_folder, exist_ok=True)
+                is_default_results_path = False
+                output_dir = output_folder
+
+        results_output_path = os.path.join(output_dir, f'PublicReportsWithUnusedData_{time}.csv')
+        summary_output_path = os.path.join(output_dir, f'PBAnalyzerResults_{time}.txt')
 
         super().__init__('Analyze Public Reports', results_output_path,
-                         is_default_results_path, summary_output_path, debug)
+                         is_default_results_path, summary_output_path, debug, max_workers)
+        self._region_urls: Dict[tuple, concurrent.futures.Future] = {}
+        self._region_urls_lock = threading.Lock()
 
     @staticmethod
     def _validate_embed_codes_file(embed_codes_path: str):
@@ -69,104 +80,122 @@ class PublicReportsAnalyzer(BaseAnalyzer):
                 raise ValueError(
                     f'CSV file does not have the expected headers. Are you sure this is an Embed Codes CSV file?')
 
-    @staticmethod
-    def _send_power_bi_request(url: str) -> Optional[str]:
-        response: requests.Response = requests.get(url)
-        if response.status_code == 200:
-            match: Optional[re.Match] = re.search(REGEX_BI_REQUEST, response.text)
-            if match:
-                return match.group(1)
-
-    @staticmethod
-    def _send_exploration_request(region_url: str, resource_key: str) -> Optional[Dict]:
+    def _send_power_bi_request(self, url: str) -> Optional[str]:
+        with self._session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                return None
+            buffer: bytes = b''
+            for chunk in response.iter_content(chunk_size=8192):
+                buffer += chunk
+                match: Optional[re.Match] = _BI_REQUEST_RE.search(buffer)
+                if match:
+                    return match.group(1).decode('utf-8')
+                buffer = buffer[-512:]
+
+    def _send_exploration_request(self, region_url: str, resource_key: str) -> Optional[Dict]:
         headers: Dict[str, str] = {'X-PowerBI-ResourceKey': resource_key}
-        response: requests.Response = requests.get(
+        response: requests.Response = self._session.get(
             PublicRequests.EXPLORATION_URL.format(region_url, resource_key),
-            headers=headers)
+            headers=headers, timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
-            return response.json()
+            return load_json(response.content)
         else:
             raise ExplorationRequestError(f'Failed to get exploration data. Status code: {response.status_code}',
-                                          response.json()['error']['code'])
+                                          self._get_error_code(response.content))
 
     @staticmethod
-    def _get_model_id(json_response: Union[str, Dict]) -> Optional[str]:
+    def _get_error_code(content: bytes) -> str:
         try:
-            data: Dict = json.loads(json_response) if isinstance(json_response, str) else json_response
-            models: List[Dict] = data.get(ResponseKeys.MODELS, [{}])
-            if models:
-                return models[0].get(ResponseKeys.ID)
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
-            return None
+            error = load_json(content).get('error')
+        except (ValueError, AttributeError):
+            return 'unknown'
+        if not isinstance(error, dict):
+            return 'unknown'
+        return error.get('code', 'unknown')
 
     @staticmethod
-    def _send_conceptual_schema_request(region_url: str, model_id: str, resource_key: str) -> Optional[Dict]:
+    def _get_model_id(data: Dict) -> Optional[str]:
+        models: List[Dict] = data.get(ResponseKeys.MODELS)
+        return models[0].get(ResponseKeys.ID) if models else None
+
+    def _send_conceptual_schema_request(self, region_url: str, model_id: str, resource_key: str) -> Optional[Dict]:
         headers: Dict[str, str] = {'X-PowerBI-ResourceKey': resource_key}
         payload: Dict[str, List[str]] = {'modelIds': [model_id]}
-        response: requests.Response = requests.post(PublicRequests.CONCEPTUAL_SCHEMA_URL.format(region_url),
-                                                    headers=headers, json=payload)
+        response: requests.Response = self._session.post(PublicRequests.CONCEPTUAL_SCHEMA_URL.format(region_url),
+                                                    headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
-            return response.json()
+            return load_json(response.content)
         else:
             response.raise_for_status()
 
     @staticmethod
     def _decode_url(encoded_url: str) -> dict:
-        parsed_url: ParseResult = urlparse(encoded_url)
-        encoded_bytes: str = parse_qs(parsed_url.query)['r'][0]
-        decoded_bytes: bytes = base64.b64decode(encoded_bytes)
-        decoded_url: str = decoded_bytes.decode('utf-8')
-        return json.loads(decoded_url)
+        match: Optional[re.Match] = _EMBED_PAYLOAD_RE.search(encoded_url)
+        if match is None:
+            raise ValueError(f'Embed URL has no report payload: {encoded_url}')
+        decoded_bytes: bytes = base64.b64decode(unquote(match.group(1)))
+        return load_json(decoded_bytes)
 
-    def _process_report(self, row, bar, start_time, *args):
+    def _process_report(self, row, deadline, *args) -> ReportResult:
         try:
-            if datetime.now() - start_time > timedelta(minutes=10):
-                raise TimeoutError('Passes the 10 minutes mark.')
+            if monotonic() > deadline:
+                raise TimeoutError(f'Passes the {ANALYSIS_TIME_LIMIT_MINUTES} minutes mark.')
 
             conceptual_schema, exploration_response = self._get_report_data(row)
-            report_columns = fetch_columns_and_tables(conceptual_schema)
-            num_of_hidden = count_hidden_true_in_dict(conceptual_schema)
+            report_columns, num_of_hidden = fetch_columns_and_hidden_count(conceptual_schema)
             report_with_unused, all_columns = get_classified_columns(report_columns, exploration_response)
-            self._insert_all_columns(all_columns, num_of_hidden)
-            self._success_count += 1
-            if report_with_unused:
-                self._reports_with_unused_columns += 1
-                self._results.append(row[:-1] + [num_of_hidden, report_with_unused])
+            result_row = row[:-1] + [num_of_hidden, report_with_unused] if report_with_unused else None
+            result = ReportResult(all_columns, num_of_hidden, result_row)
         except ExplorationRequestError as e:
-            if self._debug:
-                print(Fore.RED + str(e))
-            self._errors.append([row[0], e.args[1]])
+            result = ReportResult(error=[row[0], e.args[1], e.args[0]])
         except TimeoutError as e:
             raise e
         except Exception as e:
-            if self._debug:
-                print(Fore.RED + str(e))
-        bar()
-        return
+            result = ReportResult(error=[row[0], type(e).__name__, str(e)])
+        return result
 
     def _intro(self):
         self._handle_input()
-        rows = []
-        with open(self._embed_codes_file_path, mode='r', encoding='utf-8') as file:
+        with open(self._embed_codes_file_path, mode='r', newline='', encoding='utf-8', buffering=1 << 20) as file:
             reader = csv.reader(file)
             headers = next(reader)
-            [rows.append(row) for row in reader]
+            rows = list(reader)
         write_to_csv(self._result_output_path, [headers + NEW_HEADERS], True)
         average_time_per_report = 0.4
         estimated_time = round(len(rows) * average_time_per_report, 2)
         print(Fore.GREEN + f'Found {len(rows)} reports to analyze.')
         print(Fore.YELLOW + f'Estimated time to analyze all reports: {estimated_time} seconds.')
-        if estimated_time > 60 * 10:
-            print(Fore.RED + f'Scan will stop after approximately 10 minutes.')
+        if estimated_time > ANALYSIS_TIME_LIMIT.total_seconds():
+            print(Fore.RED + f'Scan will stop after approximately {ANALYSIS_TIME_LIMIT_MINUTES} minutes.')
         input(Fore.CYAN + "Press Enter to start the analysis...")
         print()
         print(Fore.BLUE + 'Analyzing reports...')
         return rows
 
+    def _get_region_url(self, url: str, tenant_id: Optional[str]) -> str:
+        key = (urlparse(url).netloc, tenant_id)
+        with self._region_urls_lock:
+            region_future = self._region_urls.get(key)
+            is_owner = region_future is None
+            if is_owner:
+                region_future = concurrent.futures.Future()
+                self._region_urls[key] = region_future
+        if is_owner:
+            try:
+                region_url = self._send_power_bi_request(url)
+                if region_url is None:
+                    raise ValueError(f'Failed to resolve the cluster URL of {url}')
+                region_future.set_result(region_url.replace('redirect', 'api'))
+            except Exception as e:
+                # Only the rows already waiting share the failure; later rows retry the lookup.
+                with self._region_urls_lock:
+                    self._region_urls.pop(key, None)
+                region_future.set_exception(e)
+        return region_future.result()
+
     def _get_report_data(self, row):
-        region_url = self._send_power_bi_request(row[4])
-        region_url = region_url.replace('redirect', 'api')
         decoded_url = self._decode_url(row[4])
+        region_url = self._get_region_url(row[4], decoded_url.get('t'))
         exploration_response = self._send_exploration_request(region_url, decoded_url['k'])
         model_id = self._get_model_id(exploration_response)
         conceptual_schema = self._send_conceptual_schema_request(region_url, model_id, decoded_url['k'])
@@ -182,6 +211,8 @@ class PublicReportsAnalyzer(BaseAnalyzer):
             print(Fore.RED + 'Exiting due to an error.')
             if self._debug:
                 print(Fore.RED + str(e))
+        finally:
+            self._session.close()
 
 
 def main():
@@ -189,11 +220,14 @@ def main():
     parser.add_argument('--embed-codes-path', type=str, help='Path to the Power BI Reports CSV file', required=True)
     parser.add_argument('--output-folder', type=str, help='The path to the output folder')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument('--max-workers', type=positive_int, default=MAX_WORKERS,
+                        help=f'The number of reports analyzed concurrently (default: {MAX_WORKERS})')
     args = parser.parse_args()
 
     analyzer = PublicReportsAnalyzer(
         embed_codes_file_path=args.embed_codes_path,
         output_folder=args.output_folder,
-        debug=args.debug
+        debug=args.debug,
+        max_workers=args.max_workers
     )
     analyzer.analyze()
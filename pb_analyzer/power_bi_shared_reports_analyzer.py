@@ -1,46 +1,59 @@
 import argparse
-import json
+import concurrent.futures
 import os
-from datetime import datetime, timedelta
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Dict
 from urllib.parse import urlparse
 
 import msal
 import requests
+from msal_extensions import PersistedTokenCache, build_encrypted_persistence
 from colorama import Fore
 
 from pb_analyzer.base_analyzer import BaseAnalyzer
-from pb_analyzer.const import Requests, ResponseKeys, SHARED_TO_ORG_HEADERS
-from pb_analyzer.utils import count_hidden_true_in_dict, fetch_columns_and_tables, get_classified_columns, \
-    write_to_csv
+from pb_analyzer.const import Requests, ResponseKeys, SHARED_TO_ORG_HEADERS, TOKEN_CACHE_PATH, \
+    ReportResult, MAX_WORKERS, REQUEST_TIMEOUT, ANALYSIS_TIME_LIMIT_MINUTES
+from pb_analyzer.utils import analyze_report, load_json, write_to_csv, summarize_conceptual_schema, positive_int
 
 
 class SharedReportsAnalyzer(BaseAnalyzer):
-    def __init__(self, output_folder: str = None, debug: bool = False):
+    def __init__(self, output_folder: str = None, debug: bool = False, max_workers: int = MAX_WORKERS):
         """
 
         Args:
             output_folder: The path to the output folder.
+            max_workers: The number of reports analyzed concurrently.
 
         Example usage:
         SharedToWholeOrganizationAnalyzer('C:/Users/username/Downloads/Output.csv', 'C:/Users/username/Downloads/Results.txt').analyze()
         """
         time = int(round(datetime.now().timestamp()))
         is_default_result_path = True
-
-        results_output_path = os.path.join(os.getcwd(), f'SharedReportsWithUnusedData_{time}.csv')
-        summary_output_path = os.path.join(os.getcwd(), f'PBAnalyzerResults_{time}.txt')
+        output_dir = os.getcwd()
 
         if output_folder:
             if '.' in os.path.basename(output_folder):
                 print(Fore.RED + 'Invalid output folder path. Using default path.')
-            if not os.path.isdir(output_folder):
-                os.makedirs(output_folder)
-            is_default_result_path = False
-            results_output_path = os.path.join(output_folder, f'SharedReportsWithUnusedData_{time}.csv')
-            summary_output_path = os.path.join(output_folder, f'PBAnalyzerResults_{time}.txt')
+            else:
+                os.makedirs(output_folder, exist_ok=True)
+                is_default_result_path = False
+                output_dir = output_folder
+
+        results_output_path = os.path.join(output_dir, f'SharedReportsWithUnusedData_{time}.csv')
+        summary_output_path = os.path.join(output_dir, f'PBAnalyzerResults_{time}.txt')
 
         super().__init__('Reports shared to whole organization analyzer', results_output_path, is_default_result_path,
-                         summary_output_path, debug)
+                         summary_output_path, debug, max_workers)
+        self._request_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._schema_summaries: Dict[str, concurrent.futures.Future] = {}
+        self._schema_summaries_lock = threading.Lock()
+
+    @staticmethod
+    def _create_session(pool_size: int) -> requests.Session:
+        # Each report has its schema and exploration requests in flight at the same time.
+        return BaseAnalyzer._create_session(pool_size * 2)
 
     @staticmethod
     def _extract_artifact_ids(response: dict):
@@ -55,90 +68,111 @@ class SharedReportsAnalyzer(BaseAnalyzer):
     def _get_token():
         """
         Acquires an access token using the Microsoft Authentication Library (MSAL).
+        A cached account is tried silently first; the interactive login is used only when no valid token is cached.
         """
-        app = msal.PublicClientApplication(Requests.CLIENT_ID, authority=Requests.AUTHORITY)
-        result = app.acquire_token_interactive(scopes=Requests.SCOPE, prompt='login')
+        try:
+            cache = PersistedTokenCache(build_encrypted_persistence(TOKEN_CACHE_PATH))
+        except Exception:
+            # No OS-level encryption available (e.g. no keyring on Linux): keep the cache in memory only.
+            cache = msal.SerializableTokenCache()
+
+        app = msal.PublicClientApplication(Requests.CLIENT_ID, authority=Requests.AUTHORITY, token_cache=cache)
+        result = None
+        try:
+            accounts = app.get_accounts()
+            if accounts:
+                result = app.acquire_token_silent(Requests.SCOPE, account=accounts[0])
+        except Exception:
+            # The persisted cache is unreadable (corrupt or encrypted by another user): sign in without it.
+            app = msal.PublicClientApplication(Requests.CLIENT_ID, authority=Requests.AUTHORITY)
+        if not result:
+            result = app.acquire_token_interactive(scopes=Requests.SCOPE)
 
         if ResponseKeys.ACCESS_TOKEN in result:
             return result[ResponseKeys.ACCESS_TOKEN]
         else:
             raise Exception("Failed to acquire token: %s" % result.get("error_description"))
 
-    @staticmethod
-    def _reports_published_to_web_api(token: str):
-        headers = {'authorization': f'Bearer {token}'}
-        response = requests.get(Requests.PUBLISHED_TO_WEB_URL, headers=headers)
+    def _reports_published_to_web_api(self):
+        response = self._session.get(Requests.PUBLISHED_TO_WEB_URL, timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = load_json(response.content)
             return response_data
 
-    @staticmethod
-    def _links_shared_to_whole_organization_api(token: str):
-        headers = {'authorization': f'Bearer {token}'}
-        response = requests.get(Requests.SHARED_TO_ORG_URL, headers=headers)
+    def _links_shared_to_whole_organization_api(self):
+        response = self._session.get(Requests.SHARED_TO_ORG_URL, timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = load_json(response.content)
             return response_data
 
-    @staticmethod
-    def _send_push_access_request(token: str, report_id: str, region: str):
-        headers = {'authorization': f'Bearer {token}'}
-        response = requests.post(Requests.PUSH_ACCESS_URL.format(region, report_id), headers=headers)
+    def _send_push_access_request(self, report_id: str, region: str):
+        response = self._session.post(Requests.PUSH_ACCESS_URL.format(region, report_id), timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = load_json(response.content)
             return response_data
 
-    @staticmethod
-    def _send_exploration_request(token: str, artifact_id: str, region: str):
-        headers = {'authorization': f'Bearer {token}'}
-        response = requests.get(Requests.EXPLORATION_URL.format(region, artifact_id), headers=headers)
+    def _send_exploration_request(self, artifact_id: str, region: str):
+        response = self._session.get(Requests.EXPLORATION_URL.format(region, artifact_id), timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            return response.json()
+            return load_json(response.content)
         else:
             raise Exception(f'Failed to send exploration request. Status code: {response.status_code}')
 
-    @staticmethod
-    def _send_conceptual_schema_request(token: str, model_id: str, region: str):
-        headers = {'authorization': f'Bearer {token}', 'content-type': 'application/json; charset=UTF-8'}
+    def _send_conceptual_schema_request(self, model_id: str, region: str):
         data = {"modelIds": [model_id], "userPreferredLocale": "en-US"}
-        response = requests.post(Requests.CONCEPTUAL_SCHEMA_URL.format(region), headers=headers, data=json.dumps(data))
+        response = self._session.post(Requests.CONCEPTUAL_SCHEMA_URL.format(region), json=data, timeout=REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            return response.json()
+            return load_json(response.content)
         else:
             raise Exception(f'Failed to send conceptual schema request. Status code: {response.status_code}')
 
+    def _get_schema_summary(self, model_id: str, region: str):
+        with self._schema_summaries_lock:
+            summary_future = self._schema_summaries.get(model_id)
+            is_owner = summary_future is None
+            if is_owner:
+                summary_future = concurrent.futures.Future()
+                self._schema_summaries[model_id] = summary_future
+        if is_owner:
+            try:
+                conceptual_schema = self._send_conceptual_schema_request(model_id, region)
+                summary_future.set_result(summarize_conceptual_schema(conceptual_schema))
+            except Exception as e:
+                # Only the reports already waiting share the failure; later reports retry the request.
+                with self._schema_summaries_lock:
+                    self._schema_summaries.pop(model_id, None)
+                summary_future.set_exception(e)
+        return summary_future.result()
+
     @staticmethod
     def _extract_region(response: dict):
         url = urlparse(response.get(ResponseKeys.REGION))
         return url.netloc
 
-    def _process_report(self, report, bar, start_time, *args):
-        region, token = args
+    def _process_report(self, report, deadline, *args) -> ReportResult:
+        region = args[0]
         report_id, sharer_name, name = report
+        result = ReportResult()
         try:
-            if datetime.now() - start_time > timedelta(minutes=10):
-                raise TimeoutError('Passes the 10 minutes mark.')
+            if monotonic() > deadline:
+                raise TimeoutError(f'Passes the {ANALYSIS_TIME_LIMIT_MINUTES} minutes mark.')
 
-            response_data = self._send_push_access_request(token, report_id, region)
+            response_data = self._send_push_access_request(report_id, region)
             if response_data:
-                conceptual_schema, exploration_response = self._get_report_data(region, response_data, token)
-                num_of_hidden = count_hidden_true_in_dict(conceptual_schema)
-                columns_and_tables = fetch_columns_and_tables(conceptual_schema)
-                unused_message, all_columns = get_classified_columns(columns_and_tables, exploration_response)
-                self._insert_all_columns(all_columns, num_of_hidden)
-                self._success_count += 1
-                if unused_message:
-                    self._reports_with_unused_columns += 1
-                    self._results.append([report_id, name, sharer_name, num_of_hidden, unused_message])
+                schema_summary, exploration_response = self._get_report_data(region, response_data)
+                unused_message, all_columns, num_of_hidden = analyze_report(schema_summary, exploration_response)
+                result_row = [report_id, name, sharer_name, num_of_hidden, unused_message] if unused_message else None
+                result = ReportResult(all_columns, num_of_hidden, result_row)
+        except TimeoutError as e:
+            raise e
         except Exception as e:
-            if self._debug:
-                print(Fore.RED + str(e))
-        bar()
+            result = ReportResult(error=[name, type(e).__name__, str(e)])
+        return result
 
     def _intro(self):
         self._handle_input()
@@ -147,7 +181,8 @@ class SharedReportsAnalyzer(BaseAnalyzer):
                         'your Power BI account to proceed.')
         input(Fore.CYAN + 'Press Enter to start the analysis process..')
         token = self._get_token()
-        all_shared_res = self._links_shared_to_whole_organization_api(token)
+        self._session.headers['authorization'] = f'Bearer {token}'
+        all_shared_res = self._links_shared_to_whole_organization_api()
         reports = self._extract_artifact_ids(all_shared_res)
         region = self._extract_region(all_shared_res)
         write_to_csv(self._result_output_path, [SHARED_TO_ORG_HEADERS], True)
@@ -155,36 +190,46 @@ class SharedReportsAnalyzer(BaseAnalyzer):
         estimated_time = len(reports) * average_time_per_report
         print(Fore.GREEN + f'Found {len(reports)} reports shared to whole organization.')
         print(Fore.YELLOW + f'Estimated time to analyze all reports: {estimated_time} seconds.')
-        return region, reports, token
+        return region, reports
 
-    def _get_report_data(self, region, response_data, token):
+    def _get_report_data(self, region, response_data):
         artifact_id = response_data.get(ResponseKeys.ENTITY_KEY, {}).get(ResponseKeys.ID)
-        model_id = next(item.get(ResponseKeys.ID) for item in response_data.get(ResponseKeys.RELATED_ENTITY_KEY) if
-                        item.get(ResponseKeys.TYPE) == 4)
-        conceptual_schema = self._send_conceptual_schema_request(token, model_id, region)
-        exploration_response = self._send_exploration_request(token, artifact_id, region)
-        return conceptual_schema, exploration_response
+        related_entities = {item.get(ResponseKeys.TYPE): item.get(ResponseKeys.ID) for item in
+                            response_data.get(ResponseKeys.RELATED_ENTITY_KEY, [])}
+        model_id = related_entities.get(4)
+        if model_id is None:
+            raise ValueError(f'No model found for report {artifact_id}')
+        exploration_future = self._request_executor.submit(self._send_exploration_request, artifact_id, region)
+        schema_summary = self._get_schema_summary(model_id, region)
+        exploration_response = exploration_future.result()
+        return schema_summary, exploration_response
 
     def analyze(self):
         try:
             self._welcome_text()
-            region, reports, token = self._intro()
-            end_time, reports, start_time = (self._run_analysis(reports, region, token))
+            region, reports = self._intro()
+            end_time, reports, start_time = (self._run_analysis(reports, region))
             self._outro(end_time, reports, start_time)
         except Exception as e:
             print(Fore.RED + 'Exiting due to an error.')
             if self._debug:
                 print(Fore.RED + str(e))
+        finally:
+            self._request_executor.shutdown(wait=False, cancel_futures=True)
+            self._session.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze Shared Power BI Reports')
     parser.add_argument('--output-folder', type=str, help='The path to the output folder')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument('--max-workers', type=positive_int, default=MAX_WORKERS,
+                        help=f'The number of reports analyzed concurrently (default: {MAX_WORKERS})')
     args = parser.parse_args()
 
     analyzer = SharedReportsAnalyzer(
         output_folder=args.output_folder,
-        debug=args.debug
+        debug=args.debug,
+        max_workers=args.max_workers
     )
     analyzer.analyze()
@@ -1,15 +1,47 @@
+import argparse
 import csv
 import json
 import re
-from typing import Dict, List, Union
+import sys
+from collections import defaultdict
+from functools import lru_cache
+from typing import DefaultDict, Dict, List, Set, Union
 
-from pb_analyzer.const import ResponseKeys
+from pb_analyzer.const import DATE_TABLE_PREFIXES, ReportColumn
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+_QUOTE_STRIP = str.maketrans('', '', '"\'')
+_CAMEL_CASE_SPLIT: re.Pattern = re.compile(r'(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+
+def load_json(content: Union[bytes, str]) -> Union[Dict, List]:
+    """
+    Parses a JSON document, using orjson when it is installed and the standard library otherwise.
+
+    Args:
+        content (Union[bytes, str]): The raw JSON document, e.g. the content of an HTTP response.
+
+    Returns:
+        Union[Dict, List]: The parsed JSON document.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
 
 
 def count_hidden_true_in_dict(response: Dict) -> int:
     """
     Counts the number of occurrences of the key-value pair "'Hidden': True" in the given dictionary response,
-    ignoring entities where the name starts with 'DateTableTemplate'.
+    ignoring entities where the name starts with 'DateTableTemplate' or 'LocalDateTable'.
 
     Args:
         response (Dict): The API response as a dictionary.
@@ -17,105 +49,238 @@ def count_hidden_true_in_dict(response: Dict) -> int:
     Returns:
         int: The number of occurrences of "'Hidden': True" in the response, excluding entities named 'DateTableTemplate*'.
     """
-
-    def recursive_count(data: Union[Dict, List], skip_entity: bool = False) -> int:
-        count: int = 0
-        if isinstance(data, dict):
+    count: int = 0
+    stack: List[tuple] = [(response, False)]
+    while stack:
+        data, skip_entity = stack.pop()
+        if type(data) is dict:
             for key, value in data.items():
-                if key == 'Name' and isinstance(value, str) and (
-                        value.startswith('DateTableTemplate') or value.startswith('LocalDateTable')):
+                if key == 'Name' and isinstance(value, str) and value.startswith(DATE_TABLE_PREFIXES):
                     skip_entity = True
-                if key == 'Hidden' and value is True and not skip_entity:
+                elif key == 'Hidden' and value is True and not skip_entity:
                     count += 1
-                count += recursive_count(value, skip_entity)
-        elif isinstance(data, list):
-            for item in data:
-                count += recursive_count(item, skip_entity)
-        return count
+                if type(value) is dict or type(value) is list:
+                    stack.append((value, skip_entity))
+        elif type(data) is list:
+            stack.extend((item, skip_entity) for item in data if type(item) is dict or type(item) is list)
+    return count
 
-    return recursive_count(response)
 
-
-def _extract_tables_and_columns(response: dict):
+def fetch_columns_and_hidden_count(conceptual_schema: dict) -> tuple[List[ReportColumn], int]:
     """
-    Extracts the tables and columns from the conceptual schema response.
+    Extracts the tables and columns from the conceptual schema response, skipping date template tables, and counts
+    the hidden items of the whole response.
 
     Args:
-        response (dict): The conceptual schema response as a dictionary.
+        conceptual_schema (dict): The conceptual schema response as a dictionary.
 
+    Returns:
+        tuple[List[ReportColumn], int]: The report columns and the number of hidden items.
     """
-    columns = []
-    for schema in response.get('schemas', [{}]):
+    columns: List[ReportColumn] = []
+    for schema in conceptual_schema.get('schemas', [{}]):
         if schema.get('error'):
             break
         for entity in schema.get('schema', {}).get('Entities', []):
-            table_name = entity.get('Name', 'UnknownTable')
+            table_name = sys.intern(entity.get('Name', 'UnknownTable'))
+            if any(prefix in table_name for prefix in DATE_TABLE_PREFIXES):
+                continue
             for prop in entity.get('Properties', []):
-                column_name = prop.get('Name', 'UnknownColumn')
-                columns.append({'table': table_name, 'column': column_name})
+                columns.append(ReportColumn(table_name, sys.intern(prop.get('Name', 'UnknownColumn'))))
+    return columns, count_hidden_true_in_dict(conceptual_schema)
 
-    return columns
 
+def _collect_strings(data: Union[Dict, List, str]) -> List[str]:
+    """
+    Collects the keys and string values of a parsed JSON response, walking it once with an explicit stack.
+    String values holding embedded JSON documents (e.g. visual configs) are decoded and walked as well.
 
-def fetch_columns_and_tables(conceptual_schema: dict):
+    Args:
+        data (Union[Dict, List, str]): The parsed JSON response.
+
+    Returns:
+        List[str]: All keys and string values found in the response.
+    """
+    strings: List[str] = []
+    stack: List = [data]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is dict:
+            strings.extend(node)
+            stack.extend(node.values())
+        elif node_type is list:
+            stack.extend(node)
+        elif node_type is str:
+            if node[:1] in ('{', '['):
+                try:
+                    stack.append(load_json(node))
+                    continue
+                except ValueError:
+                    pass
+            strings.append(node)
+    return strings
+
+
+def _is_whole_reference(text: str, start: int, end: int) -> bool:
+    """
+    Checks that the match at text[start:end] is not part of a longer identifier, e.g. 'User.Name' in 'User.NameFoo'.
+
+    Args:
+        text (str): The searched text.
+        start (int): The index of the first character of the match.
+        end (int): The index after the last character of the match.
+
+    Returns:
+        bool: True if the characters around the match are not identifier characters.
     """
-    Extracts and filters the tables and columns from the conceptual schema response.
+    if start > 0 and (text[start - 1].isalnum() or text[start - 1] == '_'):
+        return False
+    return end == len(text) or not (text[end].isalnum() or text[end] == '_')
 
-    Parameters:
-    conceptual_schema (dict): The conceptual schema response as a dictionary.
+
+def _find_references(references: Set[str], text: str) -> Set[str]:
     """
-    extracted_cols_and_tables = _extract_tables_and_columns(conceptual_schema)
-    filtered_cols_and_tables = [item for item in extracted_cols_and_tables if
-                                "DateTableTemplate" not in item.get('table') and "LocalDateTable" not in item.get(
-                                    'table')]
-    return filtered_cols_and_tables
+    Finds which of the given references occur in the text as whole references, matching all of them in a single scan
+    with an Aho-Corasick automaton when pyahocorasick is installed.
 
+    Args:
+        references (Set[str]): The references to look for.
+        text (str): The text to search.
 
-def get_classified_columns(report_columns: List[dict], json_string: dict, ) -> tuple[str, List[dict]]:
+    Returns:
+        Set[str]: The references found in the text.
+    """
+    found: Set[str] = set()
+    if ahocorasick is None or len(references) < 2:
+        for reference in references:
+            start = text.find(reference)
+            while start != -1:
+                if _is_whole_reference(text, start, start + len(reference)):
+                    found.add(reference)
+                    break
+                start = text.find(reference, start + 1)
+        return found
+    automaton = ahocorasick.Automaton()
+    for reference in references:
+        automaton.add_word(reference, reference)
+    automaton.make_automaton()
+    for end, reference in automaton.iter(text):
+        if reference not in found and _is_whole_reference(text, end - len(reference) + 1, end + 1):
+            found.add(reference)
+    return found
+
+
+def get_classified_columns(report_columns: List[ReportColumn], json_string: dict, ) -> tuple[str, List[ReportColumn]]:
     """
     Filters out strings from the list that are not found in the JSON string.
 
     Args:
-        report_columns (List[dict]): The list of strings to filter.
+        report_columns (List[ReportColumn]): The list of columns to filter.
         json_string (dict): The JSON string to check against.
 
     Returns:
-        tuple[str, str, List[dict]]: A tuple containing the unused columns and all columns.
+        tuple[str, List[ReportColumn]]: A tuple containing the unused columns and all columns.
     """
-    json_str: str = json.dumps(json_string)
-    normalized_json_string: str = json_str.replace('"', '').replace("'", '')
-    unused_columns_and_tables = [column for column in report_columns if
-                                 f'{column[ResponseKeys.TABLE]}.{column[ResponseKeys.COLUMN]}' not in normalized_json_string]
-    tables = {}
+    if not json_string:
+        unused_columns_and_tables = list(report_columns)
+    else:
+        strings: List[str] = _collect_strings(json_string)
+        referenced_columns = set(strings)
+        candidates = []
+        for column in report_columns:
+            column_reference = f'{column.table}.{column.column}'
+            if column_reference not in referenced_columns:
+                candidates.append((column, column_reference))
+        unused_columns_and_tables = []
+        if candidates:
+            normalized_json_string = '\n'.join(strings).translate(_QUOTE_STRIP)
+            found_references = _find_references({reference for _, reference in candidates}, normalized_json_string)
+            unused_columns_and_tables = [column for column, reference in candidates
+                                         if reference not in found_references]
+    tables: DefaultDict[str, List[str]] = defaultdict(list)
     for column in report_columns:
-        if column[ResponseKeys.TABLE] not in tables:
-            tables[column[ResponseKeys.TABLE]] = []
-        tables[column[ResponseKeys.TABLE]].append(column[ResponseKeys.COLUMN])
+        tables[column.table].append(column.column)
+
+    unused_by_table: DefaultDict[str, List[str]] = defaultdict(list)
+    for column in unused_columns_and_tables:
+        unused_by_table[column.table].append(column.column)
 
     unused_columns = []
     for table, columns in tables.items():
-        table_unused_columns = [column[ResponseKeys.COLUMN] for column in unused_columns_and_tables if
-                                column[ResponseKeys.TABLE] == table]
+        table_unused_columns = unused_by_table.get(table)
         if not table_unused_columns:
             continue
         columns.sort()
         table_unused_columns.sort()
         if table_unused_columns == columns:
             unused_columns.append(f'{table}: [.*]')
-        elif any([False if column in table_unused_columns else True for column in columns]):
+        elif not set(columns).issubset(table_unused_columns):
             unused_columns.append(f'{table}: [{", ".join(table_unused_columns)}]')
 
+    unused_keys = {(column.table, column.column) for column in unused_columns_and_tables}
     for column in report_columns:
-        column['used'] = False
-        for unused_column in unused_columns_and_tables:
-            if column[ResponseKeys.TABLE] == unused_column[ResponseKeys.TABLE] and column[ResponseKeys.COLUMN] == \
-                    unused_column[ResponseKeys.COLUMN]:
-                column[ResponseKeys.UNUSED] = True
-                break
+        if (column.table, column.column) in unused_keys:
+            column.unused = True
 
     return ', '.join(unused_columns), report_columns
 
 
+def summarize_conceptual_schema(conceptual_schema: dict) -> tuple[List[tuple[str, str]], int]:
+    """
+    Reduces the conceptual schema response to what the analysis needs, so it can be shared by every report built on
+    the same model.
+
+    Args:
+        conceptual_schema (dict): The conceptual schema response as a dictionary.
+
+    Returns:
+        tuple[List[tuple[str, str]], int]: The (table, column) names of the schema columns and the number of hidden
+        items.
+    """
+    report_columns, num_of_hidden = fetch_columns_and_hidden_count(conceptual_schema)
+    return [(column.table, column.column) for column in report_columns], num_of_hidden
+
+
+def analyze_report(schema_summary: tuple[List[tuple[str, str]], int],
+                   exploration_response: dict) -> tuple[str, List[ReportColumn], int]:
+    """
+    Classifies the columns of a report, walking its exploration response once.
+
+    Args:
+        schema_summary (tuple[List[tuple[str, str]], int]): The summary of the report conceptual schema, as returned
+            by summarize_conceptual_schema.
+        exploration_response (dict): The exploration response as a dictionary.
+
+    Returns:
+        tuple[str, List[ReportColumn], int]: The unused columns message, all the report columns and the number of
+        hidden items.
+    """
+    column_names, num_of_hidden = schema_summary
+    report_columns = [ReportColumn(table, column) for table, column in column_names]
+    unused_message, all_columns = get_classified_columns(report_columns, exploration_response)
+    return unused_message, all_columns, num_of_hidden
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument that must be a positive integer.
+
+    Args:
+        value (str): The raw argument value.
+
+    Returns:
+        int: The parsed value.
+    """
+    try:
+        number: int = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {value!r}')
+    return number
+
+
 def write_to_csv(file_path: str, values: List[List], overwrite: bool = False) -> None:
     """
     Writes values to a CSV file.
@@ -126,7 +291,7 @@ def write_to_csv(file_path: str, values: List[List], overwrite: bool = False) ->
         overwrite (bool): Whether to overwrite the file or append to it. Default is False.
     """
     mode: str = 'w' if overwrite else 'a'
-    with open(file_path, mode=mode, newline='', encoding='utf-8') as file:
+    with open(file_path, mode=mode, newline='', encoding='utf-8', buffering=1 << 16) as file:
         writer: csv.writer = csv.writer(file)
         writer.writerows(values)
 
@@ -143,6 +308,7 @@ def write_to_txt(file_path: str, values: List[str]) -> None:
         file.write('\n'.join(values))
 
 
+@lru_cache(maxsize=4096)
 def split_and_format(text):
-    split_text = re.sub(r'(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])', ' ', text)
+    split_text = _CAMEL_CASE_SPLIT.sub(' ', text)
     return split_text
@@ -3,6 +3,9 @@ from setuptools import setup, find_packages
 with open('requirements.txt') as f:
     required = f.read().splitlines()
 
+with open('README.md', encoding='utf-8') as f:
+    long_description = f.read()
+
 setup(
     name='power_bi_analyzer',
     version='1.0.2',
@@ -16,7 +19,7 @@ setup(
     author='Nokod Security',
     author_email='support@nokodsecurity.com',
     description='A package to analyze Power BI reports.',
-    long_description=open('README.md').read(),
+    long_description=long_description,
     long_description_content_type='text/markdown',
     url='https://github.com/Nokod/PBAnalyzer',
     classifiers=[
@@ -26,4 +29,7 @@ setup(
     ],
     python_requires='>=3.6',
     install_requires=required,
+    extras_require={
+        'fast': ['orjson>=3.9.0', 'pyahocorasick>=2.0.0'],
+    },
 )